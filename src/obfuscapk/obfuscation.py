@@ -401,13 +401,13 @@ class Obfuscation(object):
 
         # This method must be called AFTER the obfuscated apk has been built.
 
-        # The obfuscated apk will be signed with jarsigner.
+        # The obfuscated apk will be signed natively (or with jarsigner, if native signing is not available).
         jarsigner: Jarsigner = Jarsigner()
 
         try:
             jarsigner.resign(self.obfuscated_apk_path,
                              os.path.join(os.path.dirname(__file__), 'resources', 'obfuscation_keystore.jks'),
-                             'obfuscation_password', 'obfuscation_key')
+                             'obfuscation_password', 'obfuscation_key', native=True)
         except Exception as e:
             self.logger.error('Error during apk signing: {0}'.format(e))
             raise
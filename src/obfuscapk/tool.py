@@ -1,12 +1,150 @@
 #!/usr/bin/env python3.7
 
-import io
+import asyncio
+import base64
+import concurrent.futures
+import contextlib
+import copy
+import hashlib
 import logging
 import os
+import re
 import shutil
+import struct
 import subprocess
+import tempfile
 import zipfile
-from typing import List
+from typing import IO, Any, Dict, Iterator, List, Optional, Tuple
+
+try:
+    # ISA-L provides a faster implementation of the zlib module (used for decompressing the apk entries).
+    from isal import isal_zlib as zlib
+except ImportError:
+    import zlib
+
+
+# The output of the external tools can be very long (e.g., apktool warnings), so only its last part is kept.
+_MAX_OUTPUT_SIZE = 1024 * 1024
+
+
+def _append_output(output: bytearray, chunk: bytes) -> None:
+    output += chunk
+
+    # Keep only the last complete lines of the output (or, if there are no line breaks, cut the output at the
+    # beginning of a UTF-8 character, so it can still be decoded).
+    if len(output) > _MAX_OUTPUT_SIZE:
+        cut = output.find(b'\n', len(output) - _MAX_OUTPUT_SIZE) + 1
+        if not cut:
+            cut = len(output) - _MAX_OUTPUT_SIZE
+            while cut < len(output) and output[cut] & 0xC0 == 0x80:
+                cut += 1
+        del output[:cut]
+
+
+def _check_output(cmd: List[str]) -> bytes:
+
+    # Equivalent of subprocess.check_output(cmd, stderr=subprocess.STDOUT), but the output is read while the
+    # process is running and only its last part is kept.
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as process:
+        output = bytearray()
+        try:
+            for chunk in iter(lambda: process.stdout.read(65536), b''):
+                _append_output(output, chunk)
+        except BaseException:
+            process.kill()
+            raise
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd, output=bytes(output))
+
+    return bytes(output)
+
+
+async def _check_output_async(cmd: List[str]) -> bytes:
+
+    # Asynchronous equivalent of _check_output(cmd), to be used for running multiple external tools
+    # concurrently (e.g., when processing more apks at the same time).
+    process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.STDOUT)
+    output = bytearray()
+    try:
+        while True:
+            chunk = await process.stdout.read(65536)
+            if not chunk:
+                break
+            _append_output(output, chunk)
+        await process.wait()
+    except BaseException:
+        # Kill the process and wait for it (as the Popen context manager does in _check_output).
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd, output=bytes(output))
+
+    return bytes(output)
+
+
+@contextlib.contextmanager
+def _logged_command(logger: logging.Logger, cmd: List[str], command_name: str, operation_name: str) -> Iterator[None]:
+
+    # Log the execution of an external tool command and its errors (shared by the synchronous and asynchronous
+    # methods running the command).
+    try:
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('Running {0} command "{1}"'.format(command_name, ' '.join(cmd)))
+        yield
+    except subprocess.CalledProcessError as e:
+        logger.error('Error during {0} command: {1}'.format(
+            command_name, e.output.decode(errors='replace') if e.output else e))
+        raise
+    except Exception as e:
+        logger.error('Error during {0}: {1}'.format(operation_name, e))
+        raise
+
+
+# The directory containing the manifest and the signature files of an apk.
+_META_INF_PREFIX = 'META-INF/'
+
+_SIGNATURE_FILE_EXTENSIONS = ('.SF', '.RSA', '.DSA', '.EC')
+
+
+def _is_signature_file(file_name: str) -> bool:
+    return file_name.startswith(_META_INF_PREFIX) and file_name.upper().endswith(_SIGNATURE_FILE_EXTENSIONS)
+
+
+def _get_manifest_attribute(name: str, value: str) -> bytes:
+
+    # A manifest attribute is a "name: value" line, split into lines of at most 72 bytes (continuation lines
+    # start with a space).
+    attribute = '{0}: {1}'.format(name, value).encode()
+    lines = [attribute[:72]] + [b' ' + attribute[i:i + 71] for i in range(72, len(attribute), 71)]
+    return b''.join(line + b'\r\n' for line in lines)
+
+
+@contextlib.contextmanager
+def _replacing_apk(apk_path: str) -> Iterator[IO[bytes]]:
+
+    # Write the new content of an apk in a temp file next to the original apk and, if no error occurs, move it
+    # over the original. The temp file is synced to disk only once (after it's completely written) and it
+    # gets the permissions of the original apk (temp files are created readable only by the owner).
+    new_apk_path = None
+    try:
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(apk_path)),
+                                         suffix='.apk', delete=False) as new_apk:
+            new_apk_path = new_apk.name
+            yield new_apk
+            new_apk.flush()
+            os.fsync(new_apk.fileno())
+
+        shutil.copymode(apk_path, new_apk_path)
+        os.replace(new_apk_path, apk_path)
+    finally:
+        # Remove the temp file if something went wrong before replacing the original apk.
+        if new_apk_path and os.path.isfile(new_apk_path):
+            os.remove(new_apk_path)
 
 
 class Apktool(object):
@@ -19,7 +157,15 @@ class Apktool(object):
         else:
             self.apktool_path: str = 'apktool'
 
-    def decode(self, apk_path: str, output_dir_path: str = None, force: bool = False) -> str:
+        # apktool installs the framework needed for decoding/building in its framework directory. A custom
+        # directory can be used to keep the installed framework across multiple runs (e.g., when running
+        # in a container).
+        if 'APKTOOL_FRAMEWORK_PATH' in os.environ:
+            self.framework_path: Optional[str] = os.environ['APKTOOL_FRAMEWORK_PATH']
+        else:
+            self.framework_path: Optional[str] = None
+
+    def _get_decode_cmd(self, apk_path: str, output_dir_path: str = None, force: bool = False) -> List[str]:
 
         # Check if the apk file to decode is a valid file.
         if not os.path.isfile(apk_path):
@@ -55,19 +201,44 @@ class Apktool(object):
         if force:
             decode_cmd.insert(2, '--force')
 
-        try:
-            self.logger.info('Running decode command "{0}"'.format(' '.join(decode_cmd)))
-            output = subprocess.check_output(decode_cmd, stderr=subprocess.STDOUT).strip()
+        if self.framework_path:
+            decode_cmd.extend(['--frame-path', self.framework_path])
+
+        return decode_cmd
+
+    def decode(self, apk_path: str, output_dir_path: str = None, force: bool = False) -> str:
+
+        decode_cmd = self._get_decode_cmd(apk_path, output_dir_path, force)
+
+        with _logged_command(self.logger, decode_cmd, 'decode', 'decoding'):
+            output = _check_output(decode_cmd).strip()
             return output.decode()
-        except subprocess.CalledProcessError as e:
-            self.logger.error('Error during decode command: {0}'.format(
-                e.output.decode(errors='replace') if e.output else e))
-            raise
-        except Exception as e:
-            self.logger.error('Error during decoding: {0}'.format(e))
-            raise
 
-    def build(self, source_dir_path: str, output_apk_path: str = None) -> str:
+    @classmethod
+    def decode_many(cls, apk_paths: List[str], max_workers: int = None) -> List[str]:
+
+        # Decode multiple apk files in parallel (each one in the default output directory), using a different
+        # process for each apk. By default the number of workers is limited to the number of cpus, since
+        # every apktool instance starts a new JVM.
+        if not apk_paths:
+            return []
+
+        if not max_workers:
+            max_workers = min(len(apk_paths), os.cpu_count() or 1)
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(_decode_apk, [cls] * len(apk_paths), apk_paths))
+
+    async def decode_async(self, apk_path: str, output_dir_path: str = None, force: bool = False) -> str:
+
+        decode_cmd = self._get_decode_cmd(apk_path, output_dir_path, force)
+
+        with _logged_command(self.logger, decode_cmd, 'decode', 'decoding'):
+            output = (await _check_output_async(decode_cmd)).strip()
+            return output.decode()
+
+    def _get_build_cmd(self, source_dir_path: str, output_apk_path: str = None, force_all: bool = True,
+                       no_crunch: bool = False) -> List[str]:
 
         # Check if the input directory exists.
         if not os.path.isdir(source_dir_path):
@@ -82,22 +253,48 @@ class Apktool(object):
                               .format(os.path.join(source_dir_path, 'dist',
                                                    os.path.basename(os.path.normpath(source_dir_path)))))
 
-        build_cmd: List[str] = [self.apktool_path, 'b', '--force-all', source_dir_path]
+        build_cmd: List[str] = [self.apktool_path, 'b', source_dir_path]
+
+        # By default everything is rebuilt, but when building the same decoded directory multiple times,
+        # apktool can reuse the files already built that didn't change.
+        if force_all:
+            build_cmd.insert(2, '--force-all')
+
+        # Skip the processing of png files (useful when the resources are already optimized).
+        if no_crunch:
+            build_cmd.insert(2, '--no-crunch')
 
         if output_apk_path:
             build_cmd.extend(['-o', output_apk_path])
 
-        try:
-            self.logger.info('Running build command "{0}"'.format(' '.join(build_cmd)))
-            output = subprocess.check_output(build_cmd, stderr=subprocess.STDOUT).strip()
+        if self.framework_path:
+            build_cmd.extend(['--frame-path', self.framework_path])
+
+        return build_cmd
+
+    def build(self, source_dir_path: str, output_apk_path: str = None, force_all: bool = True,
+              no_crunch: bool = False) -> str:
+
+        build_cmd = self._get_build_cmd(source_dir_path, output_apk_path, force_all, no_crunch)
+
+        with _logged_command(self.logger, build_cmd, 'build', 'building'):
+            output = _check_output(build_cmd).strip()
             return output.decode()
-        except subprocess.CalledProcessError as e:
-            self.logger.error('Error during build command: {0}'.format(
-                e.output.decode(errors='replace') if e.output else e))
-            raise
-        except Exception as e:
-            self.logger.error('Error during building: {0}'.format(e))
-            raise
+
+    async def build_async(self, source_dir_path: str, output_apk_path: str = None, force_all: bool = True,
+                          no_crunch: bool = False) -> str:
+
+        build_cmd = self._get_build_cmd(source_dir_path, output_apk_path, force_all, no_crunch)
+
+        with _logged_command(self.logger, build_cmd, 'build', 'building'):
+            output = (await _check_output_async(build_cmd)).strip()
+            return output.decode()
+
+
+def _decode_apk(apktool_class: type, apk_path: str) -> str:
+
+    # Used by Apktool.decode_many, every worker process needs its own Apktool instance.
+    return apktool_class().decode(apk_path)
 
 
 class Jarsigner(object):
@@ -110,7 +307,13 @@ class Jarsigner(object):
         else:
             self.jarsigner_path: str = 'jarsigner'
 
-    def sign(self, apk_path: str, keystore_file_path: str, keystore_password: str, key_alias: str) -> str:
+        # The keys already loaded for native signing, so the keystore is read and decrypted only once when
+        # signing multiple apks.
+        self._keystore_cache: Dict[Tuple[str, str, str], Tuple[Any, List[Any]]] = {}
+
+    def _get_sign_cmd(self, apk_path: str, keystore_file_path: str, keystore_password: str,
+                      key_alias: str, tsa_url: Optional[str] = None, sigalg: str = 'SHA256withRSA',
+                      digestalg: str = 'SHA-256') -> List[str]:
 
         # Check if the apk file to sign is a valid file.
         if not os.path.isfile(apk_path):
@@ -118,54 +321,300 @@ class Jarsigner(object):
             raise FileNotFoundError('Unable to find file "{0}"'.format(apk_path))
 
         sign_cmd: List[str] = [self.jarsigner_path,
-                               '-tsa', 'http://timestamp.comodoca.com/rfc3161',
-                               '-sigalg', 'SHA1withRSA', '-digestalg', 'SHA1',
+                               '-sigalg', sigalg, '-digestalg', digestalg,
                                '-keystore', keystore_file_path,
                                '-storepass', keystore_password,
                                apk_path, key_alias]
 
-        try:
-            self.logger.info('Running sign command "{0}"'.format(' '.join(sign_cmd)))
-            output = subprocess.check_output(sign_cmd, stderr=subprocess.STDOUT).strip()
+        # Timestamping the signature requires a request to the timestamp authority for every signed file,
+        # so it's done only when a timestamp authority is explicitly provided.
+        if tsa_url:
+            sign_cmd[1:1] = ['-tsa', tsa_url]
+        else:
+            self.logger.debug('No timestamp authority provided, the signature will not be timestamped')
+
+        return sign_cmd
+
+    def sign(self, apk_path: str, keystore_file_path: str, keystore_password: str, key_alias: str,
+             tsa_url: Optional[str] = None, sigalg: str = 'SHA256withRSA', digestalg: str = 'SHA-256') -> str:
+
+        sign_cmd = self._get_sign_cmd(apk_path, keystore_file_path, keystore_password, key_alias, tsa_url,
+                                      sigalg, digestalg)
+
+        with _logged_command(self.logger, sign_cmd, 'sign', 'signing'):
+            output = _check_output(sign_cmd).strip()
             return output.decode()
-        except subprocess.CalledProcessError as e:
-            self.logger.error('Error during sign command: {0}'.format(
-                e.output.decode(errors='replace') if e.output else e))
-            raise
-        except Exception as e:
-            self.logger.error('Error during signing: {0}'.format(e))
-            raise
 
-    def resign(self, apk_path: str, keystore_file_path: str, keystore_password: str, key_alias: str) -> str:
+    async def sign_async(self, apk_path: str, keystore_file_path: str, keystore_password: str,
+                         key_alias: str, tsa_url: Optional[str] = None, sigalg: str = 'SHA256withRSA',
+                         digestalg: str = 'SHA-256') -> str:
 
-        # If present, delete the old signature of the apk and then sign it with the new signature. Since python
-        # doesn't allow directly deleting a file inside an archive, an OS independent solution is to create a
-        # new archive without including the signature files.
+        sign_cmd = self._get_sign_cmd(apk_path, keystore_file_path, keystore_password, key_alias, tsa_url,
+                                      sigalg, digestalg)
 
-        try:
-            unsigned_apk_buffer = io.BytesIO()
+        with _logged_command(self.logger, sign_cmd, 'sign', 'signing'):
+            output = (await _check_output_async(sign_cmd)).strip()
+            return output.decode()
 
-            with zipfile.ZipFile(apk_path, 'r') as current_apk:
-                # Check if the current apk is already signed.
-                if any(entry.filename.startswith('META-INF/') for entry in current_apk.infolist()):
+    def sign_native(self, apk_path: str, keystore_file_path: str, keystore_password: str, key_alias: str,
+                    tsa_url: Optional[str] = None, sigalg: str = 'SHA256withRSA', digestalg: str = 'SHA-256') -> str:
+
+        # Sign the apk (v1 scheme, like jarsigner) directly in python, without starting a new JVM for every
+        # signed file. This requires the optional "pyjks" and "cryptography" packages: if they are not
+        # available or if anything goes wrong, the apk is signed with jarsigner instead (timestamping and
+        # algorithms other than SHA-256 are not supported natively, so jarsigner is also used in those cases).
+
+        # Check if the apk file to sign is a valid file.
+        if not os.path.isfile(apk_path):
+            self.logger.error('Unable to find file "{0}"'.format(apk_path))
+            raise FileNotFoundError('Unable to find file "{0}"'.format(apk_path))
 
-                    self.logger.info('Removing current signature from apk "{0}"'.format(apk_path))
+        if not tsa_url and digestalg == 'SHA-256' and sigalg in ('SHA256withRSA', 'SHA256withECDSA'):
+            try:
+                self.logger.info('Signing apk "{0}" natively'.format(apk_path))
+                self._sign_native(apk_path, keystore_file_path, keystore_password, key_alias, sigalg)
+                return ''
+            except ImportError as e:
+                self.logger.info('Native signing is not available, jarsigner will be used instead: {0}'.format(e))
+            except Exception as e:
+                self.logger.warning('Unable to sign apk "{0}" natively, jarsigner will be used instead: {1}'
+                                    .format(apk_path, e))
+
+        return self.sign(apk_path, keystore_file_path, keystore_password, key_alias, tsa_url, sigalg, digestalg)
+
+    def _load_keystore(self, keystore_file_path: str, keystore_password: str,
+                       key_alias: str) -> Tuple[Any, List[Any]]:
+
+        # Load the signing key and the corresponding certificate chain from the keystore (the result is
+        # cached in this instance).
+        cache_key = (os.path.abspath(keystore_file_path), keystore_password, key_alias)
+        if cache_key in self._keystore_cache:
+            return self._keystore_cache[cache_key]
+
+        import jks
+        from cryptography import x509
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+
+        # keytool stores the aliases in lowercase.
+        keystore = jks.KeyStore.load(keystore_file_path, keystore_password)
+        key_entry = keystore.private_keys.get(key_alias) or keystore.private_keys.get(key_alias.lower())
+        if not key_entry:
+            raise KeyError('Unable to find key "{0}" in keystore "{1}"'.format(key_alias, keystore_file_path))
+        if not key_entry.is_decrypted():
+            key_entry.decrypt(keystore_password)
+
+        private_key = serialization.load_der_private_key(key_entry.pkey_pkcs8, None, default_backend())
+        certificates = [x509.load_der_x509_certificate(certificate, default_backend())
+                        for _, certificate in key_entry.cert_chain]
+
+        self._keystore_cache[cache_key] = (private_key, certificates)
+
+        return private_key, certificates
+
+    def _sign_native(self, apk_path: str, keystore_file_path: str, keystore_password: str, key_alias: str,
+                     sigalg: str) -> None:
+
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec, rsa
+        from cryptography.hazmat.primitives.serialization import pkcs7
+
+        private_key, certificates = self._load_keystore(keystore_file_path, keystore_password, key_alias)
+
+        # The signature algorithm has to match the type of the key (as required by jarsigner).
+        if isinstance(private_key, rsa.RSAPrivateKey):
+            key_sigalg, signature_block_extension = 'SHA256withRSA', 'RSA'
+        elif isinstance(private_key, ec.EllipticCurvePrivateKey):
+            key_sigalg, signature_block_extension = 'SHA256withECDSA', 'EC'
+        else:
+            raise ValueError('Unsupported type of key "{0}" for native signing'.format(key_alias))
+
+        if sigalg != key_sigalg:
+            raise ValueError('Signature algorithm "{0}" cannot be used with key "{1}"'.format(sigalg, key_alias))
+
+        # The names of the signature files are derived from the key alias, as done by jarsigner.
+        signature_name = re.sub(r'[^A-Z0-9_-]', '_', key_alias.upper()[:8])
+
+        manifest = _get_manifest_attribute('Manifest-Version', '1.0') + \
+            _get_manifest_attribute('Created-By', '1.0 (Obfuscapk)') + b'\r\n'
+        signature_file = _get_manifest_attribute('Signature-Version', '1.0') + \
+            _get_manifest_attribute('Created-By', '1.0 (Obfuscapk)') + \
+            _get_manifest_attribute('SHA-256-Digest-Manifest-Main-Attributes',
+                                    base64.b64encode(hashlib.sha256(manifest).digest()).decode())
+        signature_file_sections = b''
+
+        with zipfile.ZipFile(apk_path, 'r') as current_apk, open(apk_path, 'rb') as current_apk_file:
+            # The old manifest and signature files (if any) will be replaced by the new ones.
+            entries = [entry for entry in current_apk.infolist()
+                       if entry.filename != 'META-INF/MANIFEST.MF' and not _is_signature_file(entry.filename)]
+
+            # Add the digest of every file to the manifest, and the digest of every manifest section to the
+            # signature file.
+            for entry in entries:
+                if entry.is_dir():
+                    continue
+
+                entry_digest = self._get_entry_digest(current_apk, current_apk_file, entry)
+
+                manifest_section = _get_manifest_attribute('Name', entry.filename) + \
+                    _get_manifest_attribute('SHA-256-Digest', base64.b64encode(entry_digest).decode()) + \
+                    b'\r\n'
+                manifest += manifest_section
+                signature_file_sections += _get_manifest_attribute('Name', entry.filename) + \
+                    _get_manifest_attribute('SHA-256-Digest',
+                                            base64.b64encode(hashlib.sha256(manifest_section).digest()).decode()) + \
+                    b'\r\n'
+
+        signature_file += _get_manifest_attribute('SHA-256-Digest-Manifest',
+                                                  base64.b64encode(hashlib.sha256(manifest).digest()).decode()) + \
+            b'\r\n' + signature_file_sections
+
+        # The signature block is a detached PKCS#7 signature of the signature file.
+        signature_builder = pkcs7.PKCS7SignatureBuilder().set_data(signature_file) \
+            .add_signer(certificates[0], private_key, hashes.SHA256())
+        for certificate in certificates[1:]:
+            signature_builder = signature_builder.add_certificate(certificate)
+        signature_block = signature_builder.sign(serialization.Encoding.DER,
+                                                 [pkcs7.PKCS7Options.DetachedSignature,
+                                                  pkcs7.PKCS7Options.NoAttributes,
+                                                  pkcs7.PKCS7Options.Binary])
+
+        # Write the signed apk and replace the original one.
+        with _replacing_apk(apk_path) as signed_apk, open(apk_path, 'rb') as current_apk_file:
+            with zipfile.ZipFile(signed_apk, 'w', zipfile.ZIP_DEFLATED) as signed_apk_zip:
+                signed_apk_zip.writestr('META-INF/MANIFEST.MF', manifest)
+                signed_apk_zip.writestr('META-INF/{0}.SF'.format(signature_name), signature_file)
+                signed_apk_zip.writestr('META-INF/{0}.{1}'.format(signature_name, signature_block_extension),
+                                        signature_block)
+                for entry in entries:
+                    self._copy_raw_entry(current_apk_file, entry, signed_apk_zip)
+
+    def resign(self, apk_path: str, keystore_file_path: str, keystore_password: str, key_alias: str,
+               tsa_url: Optional[str] = None, sigalg: str = 'SHA256withRSA', digestalg: str = 'SHA-256',
+               native: bool = False) -> str:
 
-                    # Create a new in-memory archive without the signature.
-                    with zipfile.ZipFile(unsigned_apk_buffer, 'w') as unsigned_apk_zip_buffer:
-                        for entry in current_apk.infolist():
-                            if not entry.filename.startswith('META-INF/'):
-                                unsigned_apk_zip_buffer.writestr(entry, current_apk.read(entry.filename))
+        # If present, delete the old signature of the apk and then sign it with the new signature. Since python
+        # doesn't allow directly deleting a file inside an archive, an OS independent solution is to create a
+        # new archive without including the signature files. If "native" is set, the new signature is created
+        # with sign_native (falling back to jarsigner when native signing is not possible).
 
-                    # Write the in-memory archive to disk.
-                    with open(apk_path, 'wb') as unsigned_apk:
-                        unsigned_apk.write(unsigned_apk_buffer.getvalue())
+        try:
+            with zipfile.ZipFile(apk_path, 'r') as current_apk:
+                # Collect the entries to keep in the unsigned apk (all the entries not in META-INF) and check
+                # if the current apk is already signed (i.e., it contains signature files). If there are no
+                # signature files, there is no need to rewrite the apk.
+                is_signed = False
+                unsigned_entries = []
+                for entry in current_apk.infolist():
+                    if entry.filename.startswith(_META_INF_PREFIX):
+                        is_signed = is_signed or _is_signature_file(entry.filename)
+                    else:
+                        unsigned_entries.append(entry)
+
+            if is_signed:
+
+                self.logger.info('Removing current signature from apk "{0}"'.format(apk_path))
+
+                # Create the new archive and replace the original apk. The entries are not modified, so their
+                # compressed data is copied as it is, without decompressing and compressing it again.
+                with _replacing_apk(apk_path) as unsigned_apk, open(apk_path, 'rb') as current_apk_file:
+                    with zipfile.ZipFile(unsigned_apk, 'w') as unsigned_apk_zip:
+                        for entry in unsigned_entries:
+                            self._copy_raw_entry(current_apk_file, entry, unsigned_apk_zip)
 
         except Exception as e:
             self.logger.error('Error during the removal of the old signature: {0}'.format(e))
             raise
 
-        return self.sign(apk_path, keystore_file_path, keystore_password, key_alias)
+        if native:
+            return self.sign_native(apk_path, keystore_file_path, keystore_password, key_alias, tsa_url,
+                                    sigalg, digestalg)
+
+        return self.sign(apk_path, keystore_file_path, keystore_password, key_alias, tsa_url, sigalg, digestalg)
+
+    def _get_entry_digest(self, source_apk: zipfile.ZipFile, source_apk_file, entry: zipfile.ZipInfo) -> bytes:
+
+        # Compute the SHA-256 digest of the uncompressed data of an entry. Stored and deflated entries are
+        # read directly from the source apk file, so they can be decompressed with ISA-L (if available).
+
+        entry_digest = hashlib.sha256()
+
+        if entry.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            with source_apk.open(entry) as entry_in:
+                for chunk in iter(lambda: entry_in.read(1024 * 1024), b''):
+                    entry_digest.update(chunk)
+            return entry_digest.digest()
+
+        crc = 0
+        size = 0
+        decompressor = zlib.decompressobj(-15) if entry.compress_type == zipfile.ZIP_DEFLATED else None
+
+        for chunk in self._read_raw_entry_data(source_apk_file, entry):
+            # The output of the decompressor is limited, since the compression ratio can be very high.
+            data = decompressor.decompress(chunk, 1024 * 1024) if decompressor else chunk
+            while data:
+                entry_digest.update(data)
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                data = decompressor.decompress(decompressor.unconsumed_tail, 1024 * 1024) if decompressor else b''
+
+        if decompressor:
+            data = decompressor.flush()
+            entry_digest.update(data)
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+
+        if crc != entry.CRC or size != entry.file_size:
+            raise zipfile.BadZipFile('Bad CRC-32 for entry "{0}"'.format(entry.filename))
+
+        return entry_digest.digest()
+
+    def _read_raw_entry_data(self, source_apk_file, entry: zipfile.ZipInfo) -> Iterator[bytes]:
+
+        # Read the (compressed) data of an entry directly from the source apk file.
+
+        source_apk_file.seek(entry.header_offset)
+        local_header = source_apk_file.read(zipfile.sizeFileHeader)
+        if len(local_header) != zipfile.sizeFileHeader or \
+                local_header[0:4] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile('Bad local header for entry "{0}"'.format(entry.filename))
+
+        # The local header is followed by the file name and by the extra field (their length in the local
+        # header can be different from the one in the central directory, e.g., because of alignment).
+        local_header_fields = struct.unpack(zipfile.structFileHeader, local_header)
+        source_apk_file.seek(local_header_fields[10] + local_header_fields[11], os.SEEK_CUR)
+
+        remaining = entry.compress_size
+        while remaining > 0:
+            chunk = source_apk_file.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                raise zipfile.BadZipFile('Truncated data for entry "{0}"'.format(entry.filename))
+            remaining -= len(chunk)
+            yield chunk
+
+    def _copy_raw_entry(self, source_apk_file, entry: zipfile.ZipInfo, destination_zip: zipfile.ZipFile) -> None:
+
+        # Copy the (already compressed) data of an entry from the source apk file into the destination
+        # archive. Only the local header of the entry is rewritten, the central directory is then written
+        # by zipfile when the destination archive is closed.
+
+        new_entry = copy.copy(entry)
+        # CRC and sizes are already known, so they are written in the local header and the data
+        # descriptor (if any) is not needed.
+        new_entry.flag_bits &= ~0x08
+        new_entry.header_offset = destination_zip.fp.tell()
+        destination_zip.fp.write(new_entry.FileHeader(new_entry.file_size > zipfile.ZIP64_LIMIT or
+                                                      new_entry.compress_size > zipfile.ZIP64_LIMIT))
+
+        for chunk in self._read_raw_entry_data(source_apk_file, entry):
+            destination_zip.fp.write(chunk)
+
+        # Register the new entry in the destination archive (the same bookkeeping zipfile does when writing
+        # an entry), so it will be included in the central directory.
+        destination_zip.filelist.append(new_entry)
+        destination_zip.NameToInfo[new_entry.filename] = new_entry
+        destination_zip.start_dir = destination_zip.fp.tell()
+        destination_zip._didModify = True
 
 
 class Zipalign(object):
@@ -178,33 +627,49 @@ class Zipalign(object):
         else:
             self.zipalign_path: str = 'zipalign'
 
-    def align(self, apk_path: str) -> str:
+    def _get_apk_copy_path(self, apk_path: str) -> str:
 
         # Check if the apk file to align is a valid file.
         if not os.path.isfile(apk_path):
             self.logger.error('Unable to find file "{0}"'.format(apk_path))
             raise FileNotFoundError('Unable to find file "{0}"'.format(apk_path))
 
-        # Since zipalign cannot be run inplace, a temp file will be created.
+        # Since zipalign cannot be run inplace, the apk will be moved to a temp file.
         apk_copy_path = '{0}.copy.apk'.format(os.path.join(os.path.dirname(apk_path),
                                                            os.path.splitext(os.path.basename(apk_path))[0]))
 
-        try:
-            shutil.copy2(apk_path, apk_copy_path)
+        return apk_copy_path
 
-            align_cmd = [self.zipalign_path, '-f', '4', apk_copy_path, apk_path]
+    @contextlib.contextmanager
+    def _aligning(self, apk_path: str) -> Iterator[List[str]]:
 
-            self.logger.info('Running align command "{0}"'.format(' '.join(align_cmd)))
-            output = subprocess.check_output(align_cmd, stderr=subprocess.STDOUT).strip()
-            return output.decode()
-        except subprocess.CalledProcessError as e:
-            self.logger.error('Error during align command: {0}'.format(
-                e.output.decode(errors='replace') if e.output else e))
-            raise
-        except Exception as e:
-            self.logger.error('Error during aligning: {0}'.format(e))
-            raise
+        # Provide the align command to run (shared by the synchronous and asynchronous methods).
+        apk_copy_path = self._get_apk_copy_path(apk_path)
+        align_cmd = [self.zipalign_path, '-f', '4', apk_copy_path, apk_path]
+        aligned = False
+
+        try:
+            with _logged_command(self.logger, align_cmd, 'align', 'aligning'):
+                # Move the apk instead of copying it, the aligned apk will be written in the original path.
+                os.replace(apk_path, apk_copy_path)
+                yield align_cmd
+            aligned = True
         finally:
-            # Remove the temp file used for zipalign.
+            # Remove the temp file used for zipalign, or restore the original apk if the alignment failed.
             if os.path.isfile(apk_copy_path):
-                os.remove(apk_copy_path)
+                if aligned:
+                    os.remove(apk_copy_path)
+                else:
+                    os.replace(apk_copy_path, apk_path)
+
+    def align(self, apk_path: str) -> str:
+
+        with self._aligning(apk_path) as align_cmd:
+            output = _check_output(align_cmd).strip()
+            return output.decode()
+
+    async def align_async(self, apk_path: str) -> str:
+
+        with self._aligning(apk_path) as align_cmd:
+            output = (await _check_output_async(align_cmd)).strip()
+            return output.decode()